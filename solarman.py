@@ -4,26 +4,60 @@ Collect PV data from the Solarman API and send Power and Energy data (W+kWh) to
 
 __version__ = "1.0.0"
 
-import http.client
 import json
 import hashlib
 import os
 import sys
 import time
 import signal
-import string
-from paho.mqtt import client as mqtt_client
-import random
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 CONFIG_PATH = os.environ.get('CONFIG_PATH', os.getcwd() + "/")
 
+# API response fields that are not published to MQTT
+DISCARD = frozenset(("code", "msg", "requestId", "success", "dataList"))
+
+# MQTT client kept open across --repeat cycles, closed on exit
+_MQTT_CLIENT = None
+
 def signal_handler(signal, frame):
     print(f"{time_stamp()}: 🛑 [SIGINT] Exiting...")
+    if _MQTT_CLIENT is not None:
+        _MQTT_CLIENT.loop_stop()
+        _MQTT_CLIENT.disconnect()
     time.sleep(1)
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
 
+# Shared HTTPS session so keep-alive and TLS state are reused between API calls.
+# The pool holds enough connections for the concurrent fetches in run(); the API
+# POSTs only read data, so they are safe to retry on transient failures.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4, pool_block=False,
+                                       max_retries=Retry(total=2, backoff_factor=0.3, allowed_methods=None)))
+
+# Access token shared across runs, refreshed shortly before it expires
+_TOKEN_CACHE = {"token": None, "expires_at": 0.0}
+_TOKEN_LOCK = threading.Lock()
+
+
+# Request headers for the current token, rebuilt only when the token changes
+_AUTH_HEADERS = {}
+
+
+class SolarmanAPIError(Exception):
+    """Raised when a Solarman API call fails"""
+
+
+class TokenExpiredError(SolarmanAPIError):
+    """Raised when the API rejects the access token"""
+
 def load_config(file):
     """
     Load configuration
@@ -34,109 +68,181 @@ def load_config(file):
         return config
 
 
+# Last formatted timestamp, as (epoch second, text); swapped as one tuple so threads never see a torn pair
+_TS_CACHE = (0, "")
+
 def time_stamp():
     """
-    Return current time in YYYY-MM-DD hh:mm:ss
+    Return current time in YYYY-MM-DD hh:mm:ss, formatted at most once per second
     :return:
     """
-    return time.strftime("%Y-%m-%d %H:%M:%S")
+    global _TS_CACHE  # pylint: disable=global-statement
+    now = int(time.time())
+    cached = _TS_CACHE
+    if cached[0] != now:
+        cached = (now, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)))
+        _TS_CACHE = cached
+    return cached[1]
 
 
-def get_token(url, appid, secret, username, password, orgId=None):
+def log(message):
+    """
+    Print a timestamped line in a single write, so lines from the API worker
+    threads never interleave
+    """
+    sys.stdout.write(f"{time_stamp()}: {message}\n")
+
+
+def get_token(url, appid, secret, username, passhash, orgId=None):
     """
     Get a token from the API
     :return: access_token
+    :raises SolarmanAPIError: when no token could be fetched
     """
-    print(f"{time_stamp()}: 🕵️  Getting token from: {url}")
+    log(f"🕵️  Getting token from: {url}")
 
+    if orgId:
+        log(f"🕵️  Using organization ID: {orgId}")
+        payload = {"appSecret": secret, "email": username, "password": passhash, "orgId": orgId}
+    else:
+        payload = {"appSecret": secret, "email": username, "password": passhash}
+    headers = {"Content-Type": "application/json"}
     try:
-        passhash = hashlib.sha256(password.encode())
-        passhash = passhash.hexdigest()
-        conn = http.client.HTTPSConnection(url)
-        if orgId:
-            print(f"{time_stamp()}: 🕵️  Using organization ID: {orgId}")
-            payload = json.dumps({"appSecret": secret, "email": username, "password": passhash, "orgId": orgId})
-        else:
-            payload = json.dumps({"appSecret": secret, "email": username, "password": passhash})
-        headers = {"Content-Type": "application/json"}
-        url = f"//account/v1.0/token?appId={appid}&language=en"
-        conn.request("POST", url, payload, headers)
-        res = conn.getresponse()
-        data = json.loads(res.read())
-        print(f"{time_stamp()}: 🔥 Token received successfully")
-        return data["access_token"]
-    except Exception as error:  # pylint: disable=broad-except
-        print(f"{time_stamp()}: 😡 Unable to fetch token: {str(error)}")
-        return None
+        res = _SESSION.post(f"https://{url}//account/v1.0/token?appId={appid}&language=en",
+                            json=payload, headers=headers, timeout=10)
+        data = json.loads(res.content)
+        token = data["access_token"]
+        expires_in = float(data.get("expires_in") or 0)
+    except (requests.RequestException, ValueError, KeyError, TypeError) as error:
+        raise SolarmanAPIError(f"Unable to fetch token: {str(error)}") from error
+    if expires_in > 0:
+        # Refresh a little early, but never store a token that is already expired
+        expires_at = time.time() + expires_in - min(60, expires_in / 2)
+    else:
+        # No usable lifetime given, keep the token until the API rejects it
+        expires_at = float("inf")
+    log("🔥 Token received successfully")
+    _TOKEN_CACHE["token"] = token
+    _TOKEN_CACHE["expires_at"] = expires_at
+    return token
+
+
+def _auth_headers(token):
+    """
+    Return the shared request headers for a token
+    :return: headers
+    """
+    headers = _AUTH_HEADERS.get(token)
+    if headers is None:
+        headers = {"Content-Type": "application/json", "Authorization": f"bearer {token}"}
+        _AUTH_HEADERS.clear()  # one token at a time
+        _AUTH_HEADERS[token] = headers
+    return headers
+
+
+def get_cached_token(config):
+    """
+    Return the cached token, fetching a new one when missing or expired
+    :return: access_token
+    """
+    with _TOKEN_LOCK:
+        if _TOKEN_CACHE["token"] is not None and time.time() < _TOKEN_CACHE["expires_at"]:
+            return _TOKEN_CACHE["token"]
+        return get_token(config["url"], config["appid"], config["secret"], config["username"], config["password_sha256"], config["orgId"])
+
+
+def invalidate_token(rejected):
+    """
+    Drop the cached token so the next call fetches a fresh one, unless another
+    thread has already replaced the rejected token
+    """
+    with _TOKEN_LOCK:
+        if _TOKEN_CACHE["token"] == rejected:
+            _TOKEN_CACHE["token"] = None
+            _TOKEN_CACHE["expires_at"] = 0.0
+
+
+def call_with_token(config, func, *args):
+    """
+    Call an API helper with the cached token, refreshing it once if rejected
+    :return: API helper result
+    """
+    token = get_cached_token(config)
+    try:
+        return func(config["url"], *args, token)
+    except TokenExpiredError:
+        log("🕵️  Token rejected, refreshing and retrying")
+        invalidate_token(token)
+        return func(config["url"], *args, get_cached_token(config))
+
+
+def _post(url, path, payload, token):
+    """
+    POST a payload to the API with the given token
+    :return: decoded response
+    :raises SolarmanAPIError: when the request or the response is unusable
+    """
+    try:
+        res = _SESSION.post(f"https://{url}/{path}", json=payload,
+                            headers=_auth_headers(token), timeout=10)
+    except requests.RequestException as error:
+        raise SolarmanAPIError(str(error)) from error
+    if res.status_code == 401:
+        raise TokenExpiredError("access token rejected")
+    if not res.ok:
+        raise SolarmanAPIError(f"request failed with HTTP status {res.status_code}")
+    try:
+        data = json.loads(res.content)
+    except ValueError as error:
+        raise SolarmanAPIError(f"invalid response: {str(error)}") from error
+    if not isinstance(data, dict):
+        raise SolarmanAPIError("invalid response: expected a JSON object")
+    if data.get("success") is False:
+        msg = str(data.get("msg") or "request failed")
+        # Auth failures come back as HTTP 200 with a token-related message
+        if "token" in msg.lower():
+            raise TokenExpiredError(msg)
+        raise SolarmanAPIError(msg)
+    return data
 
 
 def get_station_realtime(url, stationid, token):
     """
     Return station realtime data
     :return: realtime data
+    :raises SolarmanAPIError: when the data could not be fetched
     """
-    print(f"{time_stamp()}: 🕵️  Fetching station realtime data for station: {stationid}")
-    try:
-        conn = http.client.HTTPSConnection(url)
-        payload = json.dumps({"stationId": stationid})
-        headers = {"Content-Type": "application/json", "Authorization": "bearer " + token}
-        conn.request("POST", "//station/v1.0/realTime?language=en", payload, headers)
-        res = conn.getresponse()
-        data = json.loads(res.read())
-        print(f"{time_stamp()}: 🔥 Station realtime data received successfully")
-        return data
-    except Exception as error:  # pylint: disable=broad-except
-        print(f"{time_stamp()}: 😡 Unable to fetch station realtime data: {str(error)}")
-        return None
+    log(f"🕵️  Fetching station realtime data for station: {stationid}")
+    data = _post(url, "/station/v1.0/realTime?language=en", {"stationId": stationid}, token)
+    log("🔥 Station realtime data received successfully")
+    return data
 
 
 def get_device_current_data(url, device_sn, token):
     """
     Return device current data
     :return: current data
+    :raises SolarmanAPIError: when the data could not be fetched
     """
-    print(f"{time_stamp()}: 🕵️  Fetching data for device: {device_sn}")
-    try:
-        conn = http.client.HTTPSConnection(url)
-        payload = json.dumps({"deviceSn": device_sn})
-        headers = {"Content-Type": "application/json", "Authorization": "bearer " + token}
-        conn.request("POST", "//device/v1.0/currentData?language=en", payload, headers)
-        res = conn.getresponse()
-        data = json.loads(res.read())
-        print(f"{time_stamp()}: 🔥 Device data received successfully")
-        return data
-    except Exception as error:  # pylint: disable=broad-except
-        print(f"{time_stamp()}: 😡 Unable to fetch device current data: {str(error)}")
-        return None
+    log(f"🕵️  Fetching data for device: {device_sn}")
+    data = _post(url, "/device/v1.0/currentData?language=en", {"deviceSn": device_sn}, token)
+    log("🔥 Device data received successfully")
+    return data
 
 def restruct_and_separate_current_data(data, device):
     """
     Return restructured and separated device current data
-    Original data is removed
     :return: new current data
     """
     print(f"{time_stamp()}: 🕵️  Processing data... {device}")
 
-    if data is None:
-        print(f"{time_stamp()}: 😡 Error: Unable to process data for device: {device}, data is empty")
+    if not data.get("dataList"):
+        return {}
+    return {d["name"].replace(" ", "_"): d["value"] for d in data["dataList"]}
 
-    try:
-        new_data_list = {}
-        if data["dataList"]:
-            data_list = data["dataList"]
-            for i in data_list:
-                del i["key"]
-                name = i["name"]
-                name = name.replace(" ", "_")
-                del i["name"]
-                new_data_list[name] = i["value"]
-            del data["dataList"]
-        return new_data_list
-    except Exception as error:  # pylint: disable=broad-except
-        print(f"{time_stamp()}: 😡 Error while processing data: {str(error)}")
-        return None
-    
 def connect_mqtt(broker, port, client_id, username, password):
+    from paho.mqtt import client as mqtt_client  # pylint: disable=import-outside-toplevel
+
     def on_connect(client, userdata, flags, rc, properties=None):
         if rc == 0:
             print(f"{time_stamp()}: Connected to MQTT Broker!")
@@ -146,41 +252,69 @@ def connect_mqtt(broker, port, client_id, username, password):
     client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, client_id)
     client.username_pw_set( username , password )
     client.on_connect = on_connect
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
     client.connect(broker, port)
     return client
 
-def publish(client, topic, payload, debug=False):
-    result = client.publish(topic, payload)
-    status = result[0]
-    if status == 0:
-        if debug:
-            print(f"{time_stamp()}: Send {payload} to topic {topic}")
-    else:
-        print(f"{time_stamp()}: Failed to send message to topic {topic}")
+def publish_all(client, messages, debug=False):
+    """
+    Queue a batch of (topic, payload) messages without waiting on each one,
+    then wait for the whole batch to be flushed, up to one shared deadline
+    :return: True when every message was published
+    """
+    results = []
+    success = True
+    for topic, payload in messages:
+        publish_result = client.publish(topic, payload)
+        if publish_result.rc == 0:
+            results.append((topic, publish_result))
+            if debug:
+                print(f"{time_stamp()}: Send {payload} to topic {topic}")
+        else:
+            print(f"{time_stamp()}: Failed to send message to topic {topic}")
+            success = False
+    deadline = time.monotonic() + 10
+    for topic, publish_result in results:
+        publish_result.wait_for_publish(timeout=max(deadline - time.monotonic(), 0))
+    for topic, publish_result in results:
+        if not publish_result.is_published():
+            print(f"{time_stamp()}: Message to topic {topic} was not flushed in time")
+            success = False
+    return success
+
+def _collect_fields(messages, data, prefix, topic):
+    """
+    Append a (topic, payload) message for every non-empty, non-discarded field
+    """
+    for k, v in data.items():
+        if v and k not in DISCARD:
+            messages.append((f"{topic}/{prefix}/{k}", v))
 
-def generate_client_id(length=10):
+def generate_client_id():
     """Generate a random client ID."""
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    return "solarman-" + secrets.token_urlsafe(6)
 
-def run(config):
+def run(config, client):
     """
     Output current watts and kilowatts
     :return:
     """
 
-    token = get_token(config["url"], config["appid"], config["secret"], config["username"], config["password"], config["orgId"])
-
-    if token is None:
-        print(f"{time_stamp()}: 😡 Unable to get token")
+    try:
+        token = get_cached_token(config)
+
+        if config["debug"]:
+            print(f"{time_stamp()}: 🕵️  Token: {token}")
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            f_station = executor.submit(call_with_token, config, get_station_realtime, config["stationId"])
+            f_inverter = executor.submit(call_with_token, config, get_device_current_data, config["inverterId"])
+            f_logger = executor.submit(call_with_token, config, get_device_current_data, config["loggerId"])
+        station_data, inverter_data, logger_data = f_station.result(), f_inverter.result(), f_logger.result()
+    except SolarmanAPIError as error:
+        print(f"{time_stamp()}: 😡 {str(error)}")
         return
 
-    if config["debug"]:
-        print(f"{time_stamp()}: 🕵️  Token: {token}")
-    
-    station_data = get_station_realtime(config["url"], config["stationId"], token)
-    inverter_data = get_device_current_data(config["url"], config["inverterId"], token)
-    logger_data = get_device_current_data(config["url"], config["loggerId"], token)
-
     inverter_data_list = restruct_and_separate_current_data(inverter_data, "Inverter")
     logger_data_list = restruct_and_separate_current_data(logger_data, "Logger")
 
@@ -200,54 +334,43 @@ def run(config):
         print(f"{time_stamp()}: ⚡ Logger Data List:")
         print(json.dumps(logger_data_list, indent=4, sort_keys=True))
 
-    discard = ["code", "msg", "requestId", "success"]
     topic = config["mqtt"]["topic"]
 
-    client_id = generate_client_id()
-
-    client = connect_mqtt(config["mqtt"]["broker"], config["mqtt"]["port"], client_id, config["mqtt"]["username"] , config["mqtt"]["password"] )
-    client.loop_start()
+    inverter_device_state = inverter_data.get("deviceState")
 
-    inverter_device_state = inverter_data["deviceState"] if inverter_data is not None and  "deviceState" in inverter_data else None
-
-    if inverter_device_state is None or station_data is None or logger_data is None or station_data is None:
+    if inverter_device_state is None:
         print(f"{time_stamp()}: 😡 Error: Unable to get inverter data")
         return
 
+    messages = []
+
     if inverter_device_state == 1:
         print(f"{time_stamp()}: ⚡ Inverter DeviceState: {inverter_device_state} -> Publishing MQTT...")
-        
-        print(f"{time_stamp()}: ⚡ Sending station data to mqtt")
-        for i, value in station_data.items():
-            if value and i not in discard:
-                publish(client, f"{topic}/station/{i}", value, config["debug"])
-
-        print(f"{time_stamp()}: ⚡ Sending inverter data to mqtt")
-        for i, value in inverter_data.items():
-            if value and i not in discard:
-                publish(client, f"{topic}/inverter/{i}", value, config["debug"])
-
-        print(f"{time_stamp()}: ⚡ Sending inverter data list to mqtt")
-        if inverter_data_list:
-            publish(client, f"{topic}/inverter/attributes", json.dumps(inverter_data_list), config["debug"])
-
-        print(f"{time_stamp()}: ⚡ Sending logger data to mqtt")
-        for i, value in logger_data.items():
-            if value and i not in discard:
-                publish(client, f"{topic}/logger/{i}", value, config["debug"])
-
-        print(f"{time_stamp()}: ⚡ Sending logger data list to mqtt")
-        if logger_data_list:
-            publish(client, f"{topic}/logger/attributes", json.dumps(logger_data_list), config["debug"])
 
-        print(f"{time_stamp()}: ⚡ Inverter DeviceState: {inverter_device_state} -> Publishing MQTT Completed")
+        inv_attrs_payload = json.dumps(inverter_data_list) if inverter_data_list else None
+        log_attrs_payload = json.dumps(logger_data_list) if logger_data_list else None
+
+        _collect_fields(messages, station_data, "station", topic)
+        _collect_fields(messages, inverter_data, "inverter", topic)
+        if inv_attrs_payload:
+            messages.append((f"{topic}/inverter/attributes", inv_attrs_payload))
+        _collect_fields(messages, logger_data, "logger", topic)
+        if log_attrs_payload:
+            messages.append((f"{topic}/logger/attributes", log_attrs_payload))
     else:
         print(f"{time_stamp()}: ⚡ Device is not online (may be due to nighttime shutdown), sending only status to mqtt")
-        publish(client, f"{topic}/inverter/deviceState", inverter_data["deviceState"], config["debug"])
-        publish(client, f"{topic}/logger/deviceState", logger_data["deviceState"], config["debug"])
-        print(f"{time_stamp()}: ⚡ Inverter DeviceState: {inverter_device_state} -> Only Status MQTT publish")
+        messages.append((f"{topic}/inverter/deviceState", inverter_data["deviceState"]))
+        messages.append((f"{topic}/logger/deviceState", logger_data["deviceState"]))
 
-    client.loop_stop()
+    print(f"{time_stamp()}: ⚡ Sending {len(messages)} messages to mqtt")
+    if not publish_all(client, messages, config["debug"]):
+        print(f"{time_stamp()}: 😡 Error: Not all messages were sent to mqtt")
+        return
+
+    if inverter_device_state == 1:
+        print(f"{time_stamp()}: ⚡ Inverter DeviceState: {inverter_device_state} -> Publishing MQTT Completed")
+    else:
+        print(f"{time_stamp()}: ⚡ Inverter DeviceState: {inverter_device_state} -> Only Status MQTT publish")
 
 if __name__ == "__main__":
     
@@ -262,18 +385,35 @@ if __name__ == "__main__":
 
     if os.path.exists(config_file):
         config = load_config(config_file)
+        config["password_sha256"] = hashlib.sha256(config.pop("password").encode()).hexdigest()
         interval = config.get("interval", 300)
-        if(len(sys.argv) > 1):
-            if(sys.argv[1] == "--repeat"):
-                while True:     
-                    run(config)
-                    print(f"{time_stamp()}: 💀 Sleeping for {interval} seconds...")
-                    time.sleep(interval)
-            else:
-                print(f"{time_stamp()}: ❓ Unrecognized parameter '" + sys.argv[1] + "'. Expected '--repeat', Stopping now.")
+        repeat = len(sys.argv) > 1 and sys.argv[1] == "--repeat"
+        if len(sys.argv) > 1 and not repeat:
+            print(f"{time_stamp()}: ❓ Unrecognized parameter '" + sys.argv[1] + "'. Expected '--repeat', Stopping now.")
         else:
-            print(f"{time_stamp()}: 🔥 Starting single run, use the argument '--repeat' to repeat at interval...")
-            run(config)
+            _MQTT_CLIENT = connect_mqtt(config["mqtt"]["broker"], config["mqtt"]["port"], generate_client_id(),
+                                        config["mqtt"]["username"], config["mqtt"]["password"])
+            _MQTT_CLIENT.loop_start()
+            if repeat:
+                next_run = time.monotonic()
+                while True:
+                    try:
+                        run(config, _MQTT_CLIENT)
+                    except Exception as error:  # pylint: disable=broad-except
+                        print(f"{time_stamp()}: 😡 Run failed: {str(error)}")
+                    next_run += interval
+                    sleep_for = next_run - time.monotonic()
+                    if sleep_for < 0:
+                        print(f"{time_stamp()}: 😡 Run took longer than {interval} seconds, starting next run now")
+                        next_run = time.monotonic()
+                        continue
+                    print(f"{time_stamp()}: 💀 Sleeping for {sleep_for:.0f} seconds...")
+                    time.sleep(sleep_for)
+            else:
+                print(f"{time_stamp()}: 🔥 Starting single run, use the argument '--repeat' to repeat at interval...")
+                run(config, _MQTT_CLIENT)
+            _MQTT_CLIENT.loop_stop()
+            _MQTT_CLIENT.disconnect()
     else:
         print(f"{time_stamp()}: 😡 Error reading config.json, sleeping 60sec before exit...")
         time.sleep(60)